@@ -1,19 +1,58 @@
 import streamlit as st
-import fitz  # PyMuPDF
 import pandas as pd
+import numpy as np
 import re
-import base64
 from io import BytesIO
-import tempfile
-from typing import Tuple  # Import Tuple for type hinting
 
 # ========================================================
 # 1. PDF PROCESSING ENGINE
 # ========================================================
 
+# Patterns are compiled once at import time and shared by every parse
+
+# Enhanced industrial part number pattern, found among the first three
+# tokens of a whitespace-normalized line (earliest token wins)
+PART_PATTERN = re.compile(r'''
+    ^(?:\S+\s){0,2}?     # Skip up to two leading tokens
+    ([A-Z0-9]            # Must start with alphanumeric
+    [A-Z0-9\-/]{3,}      # Main body (min 3 chars)
+    (?<![-/]))           # Cannot end with separator
+    (?=\s|$)             # Must be a whole token
+''', re.VERBOSE)
+
+# Robust amount detection (handles ₹, Rs, INR, USD formats)
+AMOUNT_PATTERN = re.compile(r'''
+    (?:(?<![\w.])(?:₹|Rs\.?|INR|USD)\s*  # Currency prefix, attached or spaced
+    |(?<![\w,])(?<!\d\.))             # ...else must start a number, not sit inside a word
+    ((?:\d{1,3}          # Main digits
+    (?:,\d{2,3})+        # Thousands / lakh separators
+    |\d+)                # ...or a plain digit run
+    (?:\.\d{1,2})?)      # Decimal part
+    (?![\w,]|\.\d)       # Must end the number
+''', re.VERBOSE)
+
+# Explicit quantity such as "2 pcs" / "4 nos"
+QTY_PATTERN = re.compile(r'\b(\d+)\s*(?:pcs?|nos?|units?|qty)\b', re.I)
+
+# Grand total row - no line items follow it (only when it carries an amount
+# and comes after a line item on the same page)
+FOOTER_PATTERN = re.compile(r'^grand\s*-?\s*total\b', re.I)
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+# Every line item carries at least one number
+DIGIT_PATTERN = re.compile(r'\d')
+
+# Lines mentioning these are headings/totals, never line items
+# ('total' also covers 'subtotal'; substring match like the old 'in' test;
+#  GST rows are named by their component, e.g. 'CGST 9%')
+SKIP_PATTERN = re.compile(r'total|tax|\b[csi]gst\b', re.I)
+
 class PDFProcessor:
     """Advanced PDF parser with industrial part number support"""
     
+    COLUMNS = ['Part Number', 'Description', 'Quantity', 'Amount']
+    
     @staticmethod
     def extract_tabular_data(doc) -> pd.DataFrame:
         """
@@ -22,65 +61,106 @@ class PDFProcessor:
         """
         def clean_text(text: str) -> str:
             """Normalize text for parsing"""
-            return re.sub(r'\s+', ' ', text).strip()
+            return WHITESPACE_PATTERN.sub(' ', text).strip()
             
-        # Enhanced industrial part number pattern
-        PART_PATTERN = re.compile(r'''
-            ^[A-Z0-9]            # Must start with alphanumeric
-            [A-Z0-9\-/]{3,}      # Main body (min 3 chars)
-            (?<![-/])$           # Cannot end with separator
-        ''', re.VERBOSE)
-        
-        # Robust amount detection (handles ₹, Rs, USD formats)
-        AMOUNT_PATTERN = re.compile(r'''
-            (?:₹|Rs?\.?|USD)?\s*  # Currency symbols
-            (\d{1,3}             # Main digits
-            (?:,\d{3})*          # Thousands separators
-            (?:\.\d{2})?)        # Decimal part
-        ''', re.VERBOSE)
-
-        parts = []
+        # One list per column; the frame is built from them at the end
+        part_nums, descriptions, quantities, amounts = [], [], [], []
+        seen = set()  # First occurrence of a part number wins
         for page in doc:
-            text = page.get_text("blocks")
+            # Reading order, so the footer is only reached after the line items
+            text = page.get_text("blocks", sort=True)
+            page_start = len(part_nums)  # A totals box above this page's items is not a footer
+            footer = False
             for block in text:
                 lines = [clean_text(l) for l in block[4].split('\n') if l.strip()]
                 for line in lines:
+                    footer = bool(len(part_nums) > page_start and FOOTER_PATTERN.match(line)
+                                  and AMOUNT_PATTERN.search(line))
+                    if footer:
+                        break
+                        
+                    # Cheap reject before the keyword scan and regexes
+                    if not DIGIT_PATTERN.search(line):
+                        continue
+                        
                     # Skip irrelevant lines (headings, totals etc.)
-                    if any(x in line.lower() for x in ['total', 'subtotal', 'tax']):
+                    if SKIP_PATTERN.search(line):
                         continue
                         
-                    tokens = line.split()
-                    if len(tokens) < 3:
+                    # Need at least three tokens (line is single-space separated)
+                    if line.count(' ') < 2:
                         continue
                         
                     # Find part number (prioritize early in line)
-                    part_num = next((t for t in tokens[:3] if PART_PATTERN.match(t)), None)
-                    if not part_num:
+                    part_match = PART_PATTERN.match(line)
+                    if not part_match:
+                        continue
+                    part_num = part_match.group(1)
+                    if part_num in seen:
                         continue
                         
-                    # Extract all monetary values
-                    amounts = [float(m.group(1).replace(',','')) 
-                             for m in AMOUNT_PATTERN.finditer(line)]
-                    if not amounts:
+                    # Extract monetary values after the part number only
+                    rest = line[part_match.end(1):]
+                    amount_matches = list(AMOUNT_PATTERN.finditer(rest))
+                    if not amount_matches:
                         continue
                         
                     # Description is between part# and first amount
-                    desc_start = line.index(part_num) + len(part_num)
-                    desc_end = line.find(str(amounts[0]))
-                    description = line[desc_start:desc_end].strip(' -•,')
+                    description = rest[:amount_matches[0].start()].strip(' -•,')
                     
                     # Standard quantity = 1 unless specified
-                    qty_match = re.search(r'(\d+)\s*(?:pcs?|nos?|units?|qty)', line, re.I)
+                    qty_match = QTY_PATTERN.search(rest)
                     quantity = float(qty_match.group(1)) if qty_match else 1.0
                     
-                    parts.append({
-                        'Part Number': part_num,
-                        'Description': description,
-                        'Quantity': quantity,
-                        'Amount': amounts[-1]  # Last amount is typically total
-                    })
+                    seen.add(part_num)
+                    part_nums.append(part_num)
+                    descriptions.append(description)
+                    quantities.append(quantity)
+                    amounts.append(float(amount_matches[-1].group(1).replace(',', '')))  # Last amount is typically total
+                if footer:
+                    break
+                    
+            # The grand total ends the document
+            if footer:
+                break
+        
+        return pd.DataFrame({
+            # Arrow-backed strings: C-level hashing when merging on part numbers
+            'Part Number': pd.array(part_nums, dtype="string[pyarrow]"),
+            'Description': pd.array(descriptions, dtype="string[pyarrow]"),
+            'Quantity': np.asarray(quantities, dtype=np.float64),
+            'Amount': np.asarray(amounts, dtype=np.float64)
+        }, columns=PDFProcessor.COLUMNS)
+        
+    @staticmethod
+    @st.cache_data(show_spinner=False)
+    def parse_pdf(pdf_bytes: bytes) -> pd.DataFrame:
+        """
+        Parse raw PDF bytes into the parts DataFrame
+        Cached on the file content, so Streamlit reruns reuse the result
+        """
+        import fitz  # PyMuPDF - deferred so the upload form renders without it
+        
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        try:
+            return PDFProcessor.extract_tabular_data(doc)
+        finally:
+            doc.close()
+            
+    @staticmethod
+    @st.cache_data(show_spinner=False)
+    def extract_raw_text(pdf_bytes: bytes) -> str:
+        """
+        Plain text of every page, for the debug view only
+        Kept separate so normal runs extract each page's text just once
+        """
+        import fitz  # PyMuPDF
         
-        return pd.DataFrame(parts)
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        try:
+            return "\n".join(page.get_text() for page in doc)
+        finally:
+            doc.close()
 
 # ========================================================
 # 2. COMPARISON ENGINE
@@ -89,6 +169,9 @@ class PDFProcessor:
 class BillComparator:
     """Performs intelligent comparison between Estimate and Bill"""
     
+    COLUMNS = ['Part Number', 'Description', 'Estimate (Inc Tax)', 'Bill (Excl Tax)',
+               'Bill (Inc Tax)', 'Tax Amount', 'Status', 'Delta']
+    
     def __init__(self):
         self.tax_rate = 0.18  # Default 18% GST
         
@@ -99,45 +182,64 @@ class BillComparator:
         Compare parts data between estimate and bill
         Returns enriched DataFrame with comparison metrics
         """
-        comparison = []
-        all_parts = set(estimate['Part Number']).union(bill['Part Number'])
-        
-        for part in all_parts:
-            est = estimate[estimate['Part Number'] == part].iloc[0] if part in estimate['Part Number'].values else None
-            bill_rec = bill[bill['Part Number'] == part].iloc[0] if part in bill['Part Number'].values else None
+        # Nothing to pair up - skip the comparison machinery entirely
+        if estimate.empty or bill.empty:
+            # Same column dtypes as a populated result
+            no_amounts = np.empty(0, dtype=np.float64)
+            return pd.DataFrame({
+                'Part Number': pd.array([], dtype="string[pyarrow]"),
+                'Description': pd.array([], dtype="string[pyarrow]"),
+                'Estimate (Inc Tax)': no_amounts,
+                'Bill (Excl Tax)': no_amounts,
+                'Bill (Inc Tax)': no_amounts,
+                'Tax Amount': no_amounts,
+                'Status': pd.Categorical([]),
+                'Delta': no_amounts
+            }, columns=self.COLUMNS)
             
-            # Determine comparison status
-            if est and not bill_rec:
-                status = "❌ Missing"
-            elif not est and bill_rec:
-                status = "🆕 New"
-            else:
-                if est['Quantity'] != bill_rec['Quantity']:
-                    status = f"🔄 Qty Changed ({est['Quantity']}→{bill_rec['Quantity']})"
-                elif est['Amount'] > bill_rec['Amount']:
-                    status = "🔽 Reduced"
-                elif est['Amount'] < bill_rec['Amount']:
-                    status = "🔺 Increased"
-                else:
-                    status = "✅ Same"
-                    
-            # Calculate tax-adjusted amounts
-            est_amount = est['Amount'] if est else 0
-            bill_pre_tax = bill_rec['Amount'] if bill_rec else 0
-            bill_with_tax = bill_pre_tax * (1 + self.tax_rate)
-            
-            comparison.append({
-                'Part Number': part,
-                'Description': est['Description'] if est else bill_rec['Description'],
-                'Estimate (Inc Tax)': est_amount,
-                'Bill (Excl Tax)': bill_pre_tax,
-                'Bill (Inc Tax)': bill_with_tax,
-                'Tax Amount': bill_with_tax - bill_pre_tax if bill_rec else 0,
-                'Status': status,
-                'Delta': bill_with_tax - est_amount if (est and bill_rec) else None
-            })
-            
-        return pd.DataFrame(comparison).sort_values('Status')
+        # Align both sides on a Part Number index (unique per side, see extract_tabular_data)
+        est_idx = estimate.set_index('Part Number')
+        bill_idx = bill.set_index('Part Number')
+        merged = est_idx.join(bill_idx, how='outer',
+                              lsuffix='_Estimate', rsuffix='_Bill',
+                              validate='one_to_one').reset_index()
+        
+        est_amount = merged['Amount_Estimate'].to_numpy(dtype=np.float64)
+        bill_amount = merged['Amount_Bill'].to_numpy(dtype=np.float64)
+        in_est = ~np.isnan(est_amount)
+        in_bill = ~np.isnan(bill_amount)
+        
+        # Determine comparison status for all rows at once
+        qty_changed = ("🔄 Qty Changed (" + merged['Quantity_Estimate'].astype(str) +
+                       "→" + merged['Quantity_Bill'].astype(str) + ")")
+        status = np.select(
+            [~in_bill,
+             ~in_est,
+             merged['Quantity_Estimate'].to_numpy() != merged['Quantity_Bill'].to_numpy(),
+             est_amount > bill_amount,
+             est_amount < bill_amount],
+            ["❌ Missing", "🆕 New", qty_changed.to_numpy(dtype=object), "🔽 Reduced", "🔺 Increased"],
+            default="✅ Same"
+        )
+        
+        # Calculate tax-adjusted amounts
+        est_amount = np.where(in_est, est_amount, 0.0)
+        bill_pre_tax = np.where(in_bill, bill_amount, 0.0)
+        bill_with_tax = bill_pre_tax * (1 + self.tax_rate)
+        
+        comparison = pd.DataFrame({
+            'Part Number': merged['Part Number'],
+            'Description': merged['Description_Estimate'].fillna(merged['Description_Bill']),
+            'Estimate (Inc Tax)': est_amount,
+            'Bill (Excl Tax)': bill_pre_tax,
+            'Bill (Inc Tax)': bill_with_tax,
+            'Tax Amount': bill_with_tax - bill_pre_tax,
+            # Few distinct values: small integer codes instead of one str per row
+            'Status': pd.Categorical(status),
+            'Delta': np.where(in_est & in_bill, bill_with_tax - est_amount, np.nan)
+        }, columns=self.COLUMNS)
+        
+        return comparison.sort_values('Status')
 
 # ========================================================
 # 3. STREAMLIT APPLICATION
@@ -170,23 +272,15 @@ class PDFComparisonApp:
         st.title("Industrial Parts Comparison Tool")
         st.markdown("Upload Estimate and Bill PDFs to analyze variances")
         
-    def _process_file(self, file) -> Tuple[pd.DataFrame, str]:
+    def _process_file(self, file) -> pd.DataFrame:
         """Handle PDF file upload and processing"""
         ext = file.name.split('.')[-1].lower()
         if ext != 'pdf':
             st.error("Only PDF files are supported")
-            return pd.DataFrame(), ""
+            return pd.DataFrame(columns=PDFProcessor.COLUMNS)
             
         with st.spinner(f"Processing {file.name}..."):
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-                tmp.write(file.read())
-                doc = fitz.open(tmp.name)
-                try:
-                    df = self.processor.extract_tabular_data(doc)
-                    raw_text = "\n".join(page.get_text() for page in doc)
-                    return df, raw_text
-                finally:
-                    doc.close()
+            return self.processor.parse_pdf(file.getvalue())
                     
     def show_debug_info(self, estimate_text, bill_text):
         """Debug panel for raw PDF content"""
@@ -213,39 +307,70 @@ class PDFComparisonApp:
         
         # Main comparison table
         st.subheader("Detailed Comparison")
+        # Same display as the Excel report's number formats
         styled_df = results_df.style.format({
-            'Estimate (Inc Tax)': "₹{:.2f}",
-            'Bill (Excl Tax)': "₹{:.2f}",
-            'Bill (Inc Tax)': "₹{:.2f}",
-            'Tax Amount': "₹{:.2f}",
-            'Delta': lambda x: "₹{:+,.2f}".format(x) if pd.notna(x) else ""
-        }).apply(self._color_status_column, axis=1)
+            'Estimate (Inc Tax)': "₹{:,.2f}",
+            'Bill (Excl Tax)': "₹{:,.2f}",
+            'Bill (Inc Tax)': "₹{:,.2f}",
+            'Tax Amount': "₹{:,.2f}",
+            'Delta': lambda x: "{}₹{:,.2f}".format('-' if x < 0 else '+', abs(x)) if pd.notna(x) else ""
+        }).apply(self._color_status_column, axis=None)
         
         st.dataframe(styled_df, use_container_width=True, height=700)
         
         # Download option
         st.markdown("---")
         self._generate_excel_download(results_df)
+        self._generate_csv_download(results_df)
         
-    def _color_status_column(self, row):
-        """Helper for DataFrame styling"""
+    def _color_status_column(self, df):
+        """Helper for DataFrame styling (whole frame in one pass)"""
         colors = {
             "🔽 Reduced": 'lightgreen',
             "🔺 Increased": 'lightcoral', 
             "🆕 New": 'lightblue',
             "❌ Missing": 'lightgray'
         }
-        return ['background-color: {}'.format(colors.get(row['Status'], ''))]*len(row)
+        css = 'background-color: ' + df['Status'].map(colors).astype(object).fillna('')
+        return pd.DataFrame({col: css for col in df.columns}, index=df.index)
         
     def _generate_excel_download(self, df):
-        """Create Excel download link"""
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False)
-        excel_data = output.getvalue()
-        b64 = base64.b64encode(excel_data).decode()
-        href = f'<a href="data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,{b64}" download="parts_comparison.xlsx">📥 Download Full Report</a>'
-        st.markdown(href, unsafe_allow_html=True)
+        """Create Excel download button (workbook is built only on click)"""
+        def build_report() -> bytes:
+            output = BytesIO()
+            # Amounts stay numeric; Excel applies the ₹ display format per column
+            num_formats = {
+                'Estimate (Inc Tax)': '"₹"#,##0.00',
+                'Bill (Excl Tax)': '"₹"#,##0.00',
+                'Bill (Inc Tax)': '"₹"#,##0.00',
+                'Tax Amount': '"₹"#,##0.00',
+                'Delta': '+"₹"#,##0.00;-"₹"#,##0.00'
+            }
+            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+                df.to_excel(writer, index=False, sheet_name='Comparison')
+                workbook, sheet = writer.book, writer.sheets['Comparison']
+                for idx, col in enumerate(df.columns):
+                    if col in num_formats:
+                        sheet.set_column(idx, idx, 16, workbook.add_format({'num_format': num_formats[col]}))
+            return output.getvalue()
+            
+        st.download_button(
+            "📥 Download Full Report",
+            data=build_report,
+            file_name="parts_comparison.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            on_click="ignore"  # A download needs no rerun of the comparison
+        )
+        
+    def _generate_csv_download(self, df):
+        """Create CSV download button (far cheaper to build than XLSX)"""
+        st.download_button(
+            "📄 Download as CSV",
+            data=lambda: df.to_csv(index=False).encode('utf-8-sig'),  # BOM so Excel reads ₹/emoji
+            file_name="parts_comparison.csv",
+            mime="text/csv",
+            on_click="ignore"
+        )
         
     def run(self):
         """Main application flow"""
@@ -259,25 +384,32 @@ class PDFComparisonApp:
             submitted = st.form_submit_button("Analyze Documents", type="primary")
             
         if submitted:
-            if not est_file or not bill_file:
+            st.session_state.analyzed = bool(est_file and bill_file)
+            if not st.session_state.analyzed:
                 st.warning("Please upload both Estimate and Bill PDFs")
                 return
                 
-            # Process both documents
-            est_df, est_text = self._process_file(est_file)
-            bill_df, bill_text = self._process_file(bill_file)
+        # Results stay up across widget reruns (e.g. the debug toggle);
+        # parsing is cached, so this does not re-read the PDFs
+        if not st.session_state.get("analyzed") or not est_file or not bill_file:
+            return
             
-            # Debug view if needed
-            show_debug = st.checkbox("Show raw PDF contents")
-            if show_debug:
-                self.show_debug_info(est_text, bill_text)
-                
-            # Run comparison if data was extracted
-            if not est_df.empty and not bill_df.empty:
-                results = self.comparator.compare(est_df, bill_df)
-                self.show_results(results)
-            else:
-                st.error("Failed to extract parts data - check PDF format")
+        # Process both documents
+        est_df = self._process_file(est_file)
+        bill_df = self._process_file(bill_file)
+        
+        # Debug view if needed (raw text is only extracted on request)
+        show_debug = st.checkbox("Show raw PDF contents")
+        if show_debug:
+            self.show_debug_info(self.processor.extract_raw_text(est_file.getvalue()),
+                                 self.processor.extract_raw_text(bill_file.getvalue()))
+            
+        # Run comparison if data was extracted
+        if not est_df.empty and not bill_df.empty:
+            results = self.comparator.compare(est_df, bill_df)
+            self.show_results(results)
+        else:
+            st.error("Failed to extract parts data - check PDF format")
 
 # ========================================================
 # MAIN EXECUTION